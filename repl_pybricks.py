@@ -12,9 +12,9 @@ Any data received from the device is directly printed to stdout.
 """
 
 import asyncio
+import os
 import sys
 import struct
-import time
 import blessed
 import platform
     
@@ -53,6 +53,16 @@ PYBRICKS_HUB_CAPABILITIES_UUID = _pybricks_uuid(0x0003)
 .. availability:: Since Pybricks protocol v1.2.0.
 """
 
+STATUS_REPORT = 0
+"""Event type of the status report event received on the command/event characteristic."""
+
+# command packets written to the command/event characteristic
+_START_REPL_PACKET = b"\x02"  # START_REPL command
+_STOP_USER_PROGRAM_PACKET = b"\x00"  # STOP_USER_PROGRAM command
+
+# unpacks the 32-bit status flags of a status report, format is parsed only once
+_STATUS_UNPACK = struct.Struct("<I").unpack_from
+
 import threading
 
 async def uart_terminal(name = "Pybricks Hub"):
@@ -63,12 +73,28 @@ async def uart_terminal(name = "Pybricks Hub"):
 
     timeout = 10
     service = PYBRICKS_SERVICE_UUID
-    
-    
-    
+
+    loop = asyncio.get_running_loop()
+
+    # keys read from the terminal, encoded as bytes
+    input_queue = asyncio.Queue()
+
     # code to do a gracefull shutdown of program on brick when this program 
     # gets closed (e.g. when console windows is closed)
-    STOP_PROGRAM = False
+    # the single stop flag of the program: it is only set in the event loop, but
+    # is_set() may be read from any thread (it just reads a bool)
+    stop_event = asyncio.Event()
+    # set when there is nothing (anymore) to clean up on the brick
+    cleanup_done = threading.Event()
+    cleanup_done.set()
+
+    def shutdown():
+        # must run in the event loop
+        # wakes up the main loop, which then stops the program on the brick;
+        # set before printing, which fails when the terminal is already gone
+        stop_event.set()
+        print("shutdown",flush=True)
+
     if platform.system() == "Windows": 
           # Asyncio for windows does not implement loop.add_signal_handler YET,
           # so we have to use signal module instead.
@@ -93,13 +119,19 @@ async def uart_terminal(name = "Pybricks Hub"):
           # note: end task from taskmanager does always a hard kill which cannot be
           #       catched in the program to do a clean exit.
           def on_exit(signal_type):  
-               # on_exit seems to run in a dummy thread different from main thread
-               nonlocal STOP_PROGRAM
-               STOP_PROGRAM = True
-               print("shutdown",flush=True)
-               # let on_exit in this dummy thread sleep, so that event loop 
-               # in other thread gets the time to close its asyncs tasks nicely.
-               time.sleep(1)
+               if cleanup_done.is_set():
+                   # repl not started (yet), e.g. during scanning: not handled, so
+                   # CTRL-C still raises a KeyboardInterrupt in the main thread
+                   return False
+               # on_exit seems to run in a dummy thread different from main thread,
+               # so let the event loop do the shutdown in its own thread
+               loop.call_soon_threadsafe(shutdown)
+               # when the console window is closed the process gets killed as soon as
+               # on_exit returns, so wait until the event loop in the other thread has
+               # stopped the program on the brick (at most 5 seconds are given to us).
+               cleanup_done.wait(4)
+               # handled: for CTRL-BREAK the program then ends by itself after the cleanup
+               return True
  
           import win32api
           win32api.SetConsoleCtrlHandler(on_exit, True)
@@ -107,19 +139,9 @@ async def uart_terminal(name = "Pybricks Hub"):
         import signal
         # src: https://www.roguelynn.com/words/asyncio-graceful-shutdowns/
         signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
-        async def shutdown():
-            nonlocal STOP_PROGRAM
-            STOP_PROGRAM = True
-            print("shutdown",flush=True)
-            # current thread is MainThread which we let sleep for a second
-            # to be sure the eventloop in its own thread can finish
-            time.sleep(1)
-
-        loop = asyncio.get_running_loop()
         for s in signals:
-            loop.add_signal_handler(
-                s, lambda s=s: asyncio.create_task(shutdown()))
-        
+            loop.add_signal_handler(s, shutdown)
+
         ## another way to shutdown: cancel all tasks and wait for it        
         # async def shutdown(loop):
         #     print("shutdown",flush=True)
@@ -133,64 +155,133 @@ async def uart_terminal(name = "Pybricks Hub"):
         #     loop.add_signal_handler(
         #         s, lambda s=s: asyncio.create_task(shutdown(loop)))
 
-    def match_uuid_and_name(device: BLEDevice, adv: AdvertisementData):
-        if service.lower() not in adv.service_uuids:
-            return False
+    # computed once instead of for every advertisement received during scanning
+    target_uuid = service.lower()
+    target_address = name.upper() if name is not None else None
 
+    def match_uuid_and_name(device: BLEDevice, adv: AdvertisementData):
+        # the name is the most selective, so check it first
         if (
             name is not None
             and adv.local_name != name
-            and device.address.upper() != name.upper()
+            and device.address.upper() != target_address
         ):
             return False
 
-        return True
+        # the scanner is already asked to filter on the service, but not every
+        # backend does, so still check it
+        return target_uuid in adv.service_uuids
 
 
     def handle_disconnect(_: BleakClient):
-        print("\rDevice was disconnected, goodbye.")
+        print("\rDevice was disconnected, goodbye.", flush=True)
+
+    # write received data as bytes directly to stdout: no decoding and encoding
+    # again by print for every notification.
+    # Because this bypasses the text layer of sys.stdout, which is not line
+    # buffered when stdout is not a tty, all prints which can happen while
+    # data is received must use flush=True to keep the output in order.
+    stdout_write = sys.stdout.buffer.write
+    stdout_flush = sys.stdout.buffer.flush
+    # output often arrives in many small notifications, so instead of flushing
+    # stdout for each of them, the output is flushed at most 5 ms later
+    FLUSH_DELAY = 0.005
+    flush_timer = None
+
+    def flush_rx():
+        nonlocal flush_timer
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer = None
+        stdout_flush()
 
     def handle_rx( sender: BleakGATTCharacteristic, data: bytearray):
+        nonlocal flush_timer
         # received data from spike prime
         #data = data.replace(b"\r\n", b"\n")
-        print(data.decode(),end='',flush=True)
-
-    def pybricks_service_handler( _: int, data: bytes) -> None:
-        nonlocal STOP_PROGRAM
-        STATUS_REPORT = 0
+        # write() takes the bytearray through the buffer protocol, so no copy is made
+        stdout_write(data)
+        if b"\n" in data:
+            # show a completed line immediately
+            flush_rx()
+        elif flush_timer is None:
+            flush_timer = loop.call_later(FLUSH_DELAY, flush_rx)
+
+    # status reports can already arrive before the repl program is started,
+    # so only a running program which stops again ends the terminal
+    program_was_running = False
+
+    def pybricks_service_handler( _: int, data: bytearray) -> None:
+        nonlocal program_was_running
         if data[0] == STATUS_REPORT:
-            # decode the payload
-            (flags,) = struct.unpack_from("<I", data, 1)
+            # decode the payload in place, without copying it
+            (flags,) = _STATUS_UNPACK(data, 1)
             # 7th bit of flags describes whether programming is running
-            program_is_running_bit = (flags >> 6) & 1
-            if program_is_running_bit == 0:
+            if (flags >> 6) & 1:
+               program_was_running = True
+            elif program_was_running:
                # program is not running so stop program
-               print("\nProgram on device stopped running.")
-               STOP_PROGRAM = True
-               
-
-    async def getchar(term,loop):
-        """ Read a char none-blocking: the event loop gets its turn during the read.
+               print("\nProgram on device stopped running.", flush=True)
+               stop_event.set()
 
-            Important that this is none-blocking because otherwise the
-            program will only really terminate after user presses another key
-            to make the read unblock.
+    def read_stdin(fd):
+        """ Read the available input when the event loop sees stdin is readable (POSIX).
 
-            It works by wait internally with a small blocking timeout of 0.2s for a key press
-            before reading the char none-blocking. Between these two async operations the event loop
-            get its turn. Then when the program is terminated, then after the blocking timeout the
-            event loop get its turn, and can close itself cleanly.
+            In raw mode every key press makes stdin readable, so the event loop can
+            watch it directly without any thread in between.
         """
-        nonlocal STOP_PROGRAM
-        while not STOP_PROGRAM:
-             # without timeout of 0.5 second wait if keyboard pressed
-             if await loop.run_in_executor(None, term.kbhit,0.2):
-                 # only when a key is pressed we can read a char none-blocking
-                 s = await loop.run_in_executor(None, term.getch)
-                 return s
-        return " "         
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            # e.g. the terminal is gone: handled like the end of input
+            data = b""
+        if data:
+            input_queue.put_nowait(data)
+        else:
+            # end of input: nothing can be typed anymore
+            loop.remove_reader(fd)
+            stop_event.set()
+
+    def read_keys(term):
+        """ Blocking key reader running in its own daemon thread (Windows).
+
+            The chars read are handed over to the event loop via the input queue, so
+            the event loop just sleeps until a key is actually pressed. The thread
+            is a daemon, so when it is still blocked in getch at exit it does not
+            keep the program alive.
+        """
+        while not stop_event.is_set():
+            s = term.getch()
+            # also take the chars which are already available, so that a burst
+            # of input wakes up the event loop only once
+            while term.kbhit(0):
+                s += term.getch()
+            loop.call_soon_threadsafe(input_queue.put_nowait, s.encode("utf-8"))
+
+    async def getchars():
+        """ Read chars none-blocking: the event loop gets its turn during the read.
+
+            Waits for at least one char and then also takes all other chars already
+            queued, so that fast typing or pasting is sent to the device in one write.
+
+            Returns None when the program is stopped, so that the program does not
+            have to wait until the user presses another key before it can terminate.
+        """
+        get_task = asyncio.ensure_future(input_queue.get())
+        stop_task = asyncio.ensure_future(stop_event.wait())
+        done, pending = await asyncio.wait(
+            {get_task, stop_task}, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in pending:
+            task.cancel()
+        if get_task not in done:
+            return None
+        chars = [get_task.result()]
+        while not input_queue.empty():
+            chars.append(input_queue.get_nowait())
+        return b"".join(chars)
 
-    print("searching for device: '{}'".format(name))
+    print("searching for device: '{}'".format(name), flush=True)
 
     device = await BleakScanner.find_device_by_filter(
        match_uuid_and_name, timeout, service_uuids=[service]
@@ -201,51 +292,94 @@ async def uart_terminal(name = "Pybricks Hub"):
         sys.exit(1)
 
     async with BleakClient(device, disconnected_callback=handle_disconnect) as client:
-        
-        await client.start_notify(UART_TX_CHAR_UUID, handle_rx)
+        # subscribe to both characteristics at the same time, before starting the
+        # repl program so that none of its output or events get lost
+        await asyncio.gather(
+            client.start_notify(UART_TX_CHAR_UUID, handle_rx),
+            client.start_notify(PYBRICKS_COMMAND_EVENT_UUID, pybricks_service_handler),
+        )
 
-        print("Connected, start typing and press ENTER...")
+        print("Connected, start typing and press ENTER...", flush=True)
 
-        loop = asyncio.get_running_loop()
         nus = client.services.get_service(UART_SERVICE_UUID)
         rx_char = nus.get_characteristic(UART_RX_CHAR_UUID)
+        # the NUS RX characteristic supports write without response, which does not
+        # wait a full connection interval for the acknowledgement of every write
+        rx_response = "write-without-response" not in rx_char.properties
+        # a write without response must fit in a single packet
+        rx_chunk_size = rx_char.max_write_without_response_size
+
+        async def write_rx(data):
+            # the characteristic object is passed and not its handle or uuid,
+            # because then bleak does not have to look it up on every write
+            for i in range(0, len(data), rx_chunk_size):
+                await client.write_gatt_char(
+                    rx_char, data[i:i + rx_chunk_size], response=rx_response
+                )
 
-        # start repl program on brick, waits on response 
-        START_REPL = 2
+        # start repl program on brick, waits on response: the hub reports in the
+        # response whether it accepted the command. The write is not gathered with
+        # the subscriptions above, because the repl output must not arrive before
+        # notifications of the UART TX characteristic are enabled.
         await client.write_gatt_char(
             PYBRICKS_COMMAND_EVENT_UUID,
-            struct.pack("<B", START_REPL),
+            _START_REPL_PACKET,
             response=True,
         )
 
-        await client.start_notify(PYBRICKS_COMMAND_EVENT_UUID, pybricks_service_handler)
-
         # Implementing a real terminal program which puts stdin in raw mode so that things
         # like CTRL+C get passed to the remote device.
         # Set terminal in raw mode:
         term=blessed.Terminal()
         with term.raw():
-            # in a loop read a line of input and send it to the spike prime
+            cleanup_done.clear()
+            # only set once stdin is watched by the event loop
+            stdin_fd = None
             try:
-                while not STOP_PROGRAM:
-                    # read a char none-blocking: the event loop gets its turn during the read
-                    s = await getchar(term,loop)
-                    data = bytearray()
-                    data.extend(map(ord, s))
-                    await client.write_gatt_char(rx_char, data)
+                if platform.system() == "Windows":
+                    # asyncio on windows cannot watch the console for input, so the
+                    # blocking terminal reads are done in a dedicated thread (not in a
+                    # thread pool like the default executor, which bleak also uses)
+                    reader = threading.Thread(
+                        target=read_keys, args=(term,), name="tty", daemon=True
+                    )
+                    reader.start()
+                else:
+                    # fails when stdin cannot be watched (e.g. redirected from a
+                    # regular file), then the finally below still stops the repl
+                    fd = sys.stdin.fileno()
+                    loop.add_reader(fd, read_stdin, fd)
+                    stdin_fd = fd
+                # in a loop read a line of input and send it to the spike prime
+                while not stop_event.is_set():
+                    # read chars none-blocking: the event loop gets its turn during the read
+                    data = await getchars()
+                    if data is None:
+                        break
+                    await write_rx(data)
             finally:
-                # stop repl program on brick (does even stop the program on the brick when terminal is closed)
-                # first send ctrl-c to stop any running program in the repl
-                await client.write_gatt_char(rx_char, b'\x03')
-                # then stop the repl program itself
-                STOP_USER_PROGRAM = 0
-                await client.write_gatt_char(
-                    PYBRICKS_COMMAND_EVENT_UUID,
-                    struct.pack("<B", STOP_USER_PROGRAM),
-                    response=True,
-                )
-                await client.stop_notify(UART_TX_CHAR_UUID)
-                await client.stop_notify(PYBRICKS_COMMAND_EVENT_UUID)
+                # also stops the reader thread on windows when leaving on an error
+                stop_event.set()
+                if stdin_fd is not None:
+                    loop.remove_reader(stdin_fd)
+                try:
+                    # stop repl program on brick (does even stop the program on the brick when terminal is closed)
+                    # first send ctrl-c to stop any running program in the repl
+                    await write_rx(b'\x03')
+                    # then stop the repl program itself
+                    await client.write_gatt_char(
+                        PYBRICKS_COMMAND_EVENT_UUID,
+                        _STOP_USER_PROGRAM_PACKET,
+                        response=True,
+                    )
+                    await client.stop_notify(UART_TX_CHAR_UUID)
+                    await client.stop_notify(PYBRICKS_COMMAND_EVENT_UUID)
+                finally:
+                    # also when the brick is already gone, so that on_exit on
+                    # windows does not wait for a cleanup which never finishes;
+                    # set before flushing, which fails when stdout is gone
+                    cleanup_done.set()
+                    flush_rx()
 
 if __name__ == "__main__":
     try: